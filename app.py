@@ -1,17 +1,72 @@
 # app.py
 import os
 import io
-import re
 import pandas as pd
 import streamlit as st
 from core import (
     build_postal_lookup_from_df,
-    process_dataframe,
+    iter_process_chunks,
     load_gazetteer_subset,  # <-- new: memory-light built-in loader
     normalize_postal,
+    normalize_postal_series,
 )
+from core_cache import clear_cached_distances
 
 st.set_page_config(page_title="Driving Distance Helper", layout="wide")
+
+STUDY_CHUNK_ROWS = 10_000
+
+
+def _study_encoding(raw: bytes) -> str:
+    try:
+        raw.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+
+def _read_study(raw: bytes, encoding: str, **kwargs):
+    # Study CSV straight from the upload bytes; pass chunksize= to stream it.
+    # Cells are kept as verbatim text: dtypes inferred per chunk would format
+    # one column differently across chunks (e.g. '3' vs '10004.0').
+    return pd.read_csv(io.BytesIO(raw), encoding=encoding, dtype=str, keep_default_na=False, **kwargs)
+
+
+# Streamlit reruns the script on every widget change; these parse each
+# uploaded file once (keyed on its bytes) and serve reruns from memory.
+@st.cache_data(show_spinner=False)
+def _parse_study_preview(raw: bytes):
+    encoding = _study_encoding(raw)
+    return encoding, _read_study(raw, encoding, nrows=20)
+
+
+@st.cache_data(show_spinner=False)
+def _normalize_study_postals(raw: bytes, encoding: str, postal_col: str):
+    # Only the postal column (raw + normalized) is materialized; subset prep,
+    # pre-flight and routing all reuse it instead of re-normalizing.
+    # All columns are parsed (chunk by chunk, as routing will), so malformed
+    # rows raise here, before any ORS request is spent.
+    parts = [c[postal_col] for c in _read_study(raw, encoding, chunksize=STUDY_CHUNK_ROWS)]
+    postals = pd.concat(parts, ignore_index=True) if parts else pd.Series(dtype=object, name=postal_col)
+    return postals, normalize_postal_series(postals)
+
+
+@st.cache_data(show_spinner=False)
+def _parse_gazetteer_csv(raw: bytes) -> pd.DataFrame:
+    # The C parser skips bad lines too; low_memory=False keeps column dtypes
+    # consistent instead of guessing them per internal block
+    try:
+        return pd.read_csv(io.BytesIO(raw), engine="c", on_bad_lines="skip", low_memory=False)
+    except pd.errors.ParserError:  # e.g. an unterminated quote: let the Python engine try
+        return pd.read_csv(io.BytesIO(raw), engine="python", on_bad_lines="skip")
+
+
+@st.cache_data(show_spinner=False)
+def _build_uploaded_lookup(gdf: pd.DataFrame, col_post: str, col_lat: str, col_lon: str):
+    # Keyed on the uploaded frame's contents + column choice; reruns reuse it
+    return build_postal_lookup_from_df(gdf, col_post, col_lat, col_lon)
+
+
 st.title("Driving Distance Helper")
 st.markdown("Upload your study CSV, map the columns, set the origin, and download distances.")
 
@@ -49,7 +104,26 @@ if st.session_state["show_ors_help"]:
         st.session_state["show_ors_help"] = False
 
 with st.expander("Advanced settings", expanded=False):
-    sleep_s = st.slider("Delay between requests (seconds)", 0.0, 2.0, 1.0, 0.1)
+    ac1, ac2 = st.columns(2)
+    requests_per_minute = ac1.number_input(
+        "Requests per minute", min_value=1, max_value=1000, value=40, step=1,
+        help="Global ORS request budget (free plan: 40 directions requests/minute).",
+    )
+    max_concurrency = ac2.number_input(
+        "Parallel requests", min_value=1, max_value=32, value=8, step=1,
+        help="How many ORS requests may be in flight at once.",
+    )
+    max_straight_km = st.number_input(
+        "Only route if straight-line distance is under (km)", min_value=0, value=0, step=50,
+        help="Destinations farther than this (as the crow flies) are not sent to ORS. 0 = route everything.",
+    )
+    use_cache = st.checkbox(
+        "Use cached distances", value=True,
+        help="Reuse distances computed in earlier runs instead of asking ORS again.",
+    )
+    if st.button("Clear cache"):
+        clear_cached_distances()
+        st.success("Cached distances cleared.")
 
 # --- STEP 2: Upload study CSV ---
 st.subheader("1) Upload STUDY CSV")
@@ -57,19 +131,17 @@ up = st.file_uploader("Choose your study CSV", type=["csv"])
 if not up:
     st.stop()
 
-try:
-    df = pd.read_csv(up)
-except Exception:
-    up.seek(0)
-    df = pd.read_csv(up, encoding="latin-1")
+# The study is streamed in chunks at Compute time; only a preview is parsed here
+study_raw = up.getvalue()
+study_enc, preview = _parse_study_preview(study_raw)
 
 st.write("Preview")
-st.dataframe(df.head(20), use_container_width=True)
+st.dataframe(preview, use_container_width=True)
 
 # --- STEP 3: Map columns ---
 st.subheader("2) Map columns")
-study_id_col = st.selectbox("Study ID column", list(df.columns))
-postal_col = st.selectbox("Postal code column", list(df.columns))
+study_id_col = st.selectbox("Study ID column", list(preview.columns))
+postal_col = st.selectbox("Postal code column", list(preview.columns))
 
 # --- STEP 4: Origin (postal or coordinates) ---
 st.subheader("3) Origin")
@@ -124,7 +196,7 @@ if st.session_state["gaz_mode"] == "builtin":
 elif st.session_state["gaz_mode"] == "upload":
     gaz = st.file_uploader("Upload gazetteer CSV (columns like: postal, lat, lon)", type=["csv"], key="gaz")
     if gaz:
-        gdf = pd.read_csv(gaz, engine="python", on_bad_lines="skip")
+        gdf = _parse_gazetteer_csv(gaz.getvalue())
         st.write("Gazetteer preview")
         st.dataframe(gdf.head(10), use_container_width=True)
 
@@ -138,12 +210,14 @@ elif st.session_state["gaz_mode"] == "upload":
         col_lon  = cc3.selectbox("Longitude column", list(gdf.columns), index=list(gdf.columns).index(guess_lon))
 
         if st.button("Build gazetteer map (from upload)"):
-            st.session_state["postal_lookup"] = build_postal_lookup_from_df(gdf, col_post, col_lat, col_lon)
-            st.success(f"Loaded {len(st.session_state['postal_lookup'])//2} unique postal codes from uploaded file.")
+            st.session_state["postal_lookup"] = _build_uploaded_lookup(gdf, col_post, col_lat, col_lon)
+            lkp = st.session_state["postal_lookup"]
+            n_fsa = len(lkp.fsa) if lkp.fsa is not None else 0
+            st.success(f"Loaded {len(lkp)} unique postal codes and {n_fsa} FSA centroids from uploaded file.")
 
 # Status line
 if st.session_state["postal_lookup"]:
-    sample_keys = list(st.session_state["postal_lookup"].keys())[:5]
+    sample_keys = st.session_state["postal_lookup"].keys[:5].tolist()
     mode = st.session_state["gaz_mode"] or "none"
     st.caption(f"Gazetteer mode: {mode}. Example keys: {sample_keys}")
 else:
@@ -159,21 +233,19 @@ if run:
         st.error("OpenRouteService key missing. Paste your own key above to enable routing.")
         st.stop()
 
+    try:
+        study_postals, study_norm = _normalize_study_postals(study_raw, study_enc, postal_col)
+    except pd.errors.ParserError as e:
+        st.error(f"Could not parse the study CSV (fix the malformed rows and re-upload): {e}")
+        st.stop()
+
     # 2) If using built-in and no lookup yet, build a subset just for the rows we need
     if not st.session_state.get("postal_lookup"):
         if st.session_state.get("gaz_mode") == "builtin":
             st.info("Preparing a memory-light gazetteer subset (only the postals in your CSV, plus origin if provided)...")
 
             # Normalize & de-duplicate needed postals from the study CSV
-            def norm_any(s: str) -> str:
-                s = "" if s is None else str(s).upper()
-                m = re.search(r'([A-Z]\s*[\d]\s*[A-Z]\s*[\d]\s*[A-Z]\s*[\d])', s)
-                if not m:
-                    return ""
-                alnum = "".join(ch for ch in m.group(1) if ch.isalnum())
-                return (alnum[:3] + " " + alnum[3:]) if len(alnum) == 6 else ""
-
-            needed = set(df[postal_col].astype(str).map(norm_any).tolist())
+            needed = set(study_norm.unique()) - {""}
 
             # include origin postal if user typed one
             if origin_pc_raw:
@@ -181,11 +253,13 @@ if run:
 
             try:
                 subset = load_gazetteer_subset(needed_postals=needed)
-                if not subset:
+                if not subset:  # no exact postals and no FSA centroids either
                     st.error("Couldn’t find any of the needed postal codes in the built-in gazetteer.")
                     st.stop()
                 st.session_state["postal_lookup"] = subset
-                st.success(f"Prepared gazetteer subset with ~{len(subset)//2} unique postal codes.")
+                n_fsa = len(subset.fsa) if subset.fsa is not None else 0
+                st.success(f"Prepared gazetteer subset with {len(subset)} unique postal codes "
+                           f"({n_fsa} FSA centroids for fallback).")
             except Exception as e:
                 st.error(f"Failed to prepare gazetteer subset: {e}")
                 st.stop()
@@ -197,52 +271,69 @@ if run:
     if origin_lon is None or origin_lat is None:
         if origin_pc_raw:
             pc_norm = normalize_postal(origin_pc_raw)
-            latlon = st.session_state["postal_lookup"].get(pc_norm) or st.session_state["postal_lookup"].get(pc_norm.replace(" ", ""))
+            lkp = st.session_state["postal_lookup"]
+            latlon = lkp.get(pc_norm)
+            located = "postal code"
+            if not latlon and pc_norm and lkp.fsa is not None:
+                latlon = lkp.fsa.get(pc_norm[:3])
+                located = f"FSA {pc_norm[:3]} centroid (postal code not in gazetteer)"
             if latlon:
                 origin_lat, origin_lon = float(latlon[0]), float(latlon[1])
-                st.success(f"Origin resolved → lat={origin_lat:.6f}, lon={origin_lon:.6f}")
+                st.success(f"Origin resolved by {located} → lat={origin_lat:.6f}, lon={origin_lon:.6f}")
         if origin_lon is None or origin_lat is None:
             st.error("Origin is not set. Enter a postal code (recommended) or coordinates.")
             st.stop()
 
     # ---- Pre-flight diagnostics: how many study postals will match? ----
-    def norm_any_pre(s: str) -> str:
-        s = "" if s is None else str(s).upper()
-        m = re.search(r'([A-Z]\s*[\d]\s*[A-Z]\s*[\d]\s*[A-Z]\s*[\d])', s)
-        if not m:
-            return ""
-        alnum = "".join(ch for ch in m.group(1) if ch.isalnum())
-        return (alnum[:3] + " " + alnum[3:]) if len(alnum) == 6 else ""
-
-    lkp = st.session_state.get("postal_lookup", {})
-    study_norm = df[postal_col].astype(str).map(norm_any_pre)
-    missing_mask = ~study_norm.isin(lkp.keys())
+    lkp = st.session_state["postal_lookup"]
+    missing_mask = ~study_norm.isin(lkp.keys)
     missing_count = int(missing_mask.sum())
-    total_rows = len(df)
+    total_rows = len(study_norm)
     st.info(f"Pre-flight: {total_rows - missing_count}/{total_rows} rows will match the gazetteer.")
+    if missing_count and lkp.fsa is not None:
+        fsa_count = int((missing_mask & study_norm.ne("") & study_norm.str[:3].isin(lkp.fsa.keys)).sum())
+        if fsa_count:
+            st.info(f"{fsa_count} of the unmatched rows will use their FSA centroid instead (see `located_by`).")
     if missing_count:
-        examples = df.loc[missing_mask, postal_col].astype(str).head(10).tolist()
+        examples = study_postals[missing_mask].astype(str).head(10).tolist()
         st.warning(f"First {min(10, missing_count)} unmatched examples: {examples}")
 
-    # ---- Routing ----
-    with st.spinner("Routing..."):
-        out = process_dataframe(
-            df=df,
+    # ---- Routing (chunk by chunk; results are written out as they arrive) ----
+    csv_parts = []  # encoded CSV per chunk; joined once for the download
+    head = None
+    done_rows = 0
+    progress = st.progress(0.0, text="Routing...")
+    try:
+        for out in iter_process_chunks(
+            _read_study(study_raw, study_enc, chunksize=STUDY_CHUNK_ROWS),
             study_id_col=study_id_col,
             postal_col=postal_col,
             origin_lon=float(origin_lon),
             origin_lat=float(origin_lat),
             postal_lookup=st.session_state["postal_lookup"],
             api_key=key,
-            sleep_s=sleep_s,
-        )
+            normalized_postals=study_norm,
+            max_concurrency=int(max_concurrency),
+            requests_per_minute=int(requests_per_minute),
+            use_cache=use_cache,
+            max_straight_km=float(max_straight_km) or None,
+        ):
+            csv_parts.append(out.to_csv(index=False, header=head is None).encode())
+            if head is None:
+                head = out.head(30)
+            done_rows += len(out)
+            progress.progress(min(1.0, done_rows / max(total_rows, 1)), text=f"Routing... {done_rows}/{total_rows} rows")
+    except pd.errors.ParserError as e:  # validated up front; guards the stream regardless
+        st.error(f"Could not parse the study CSV after {done_rows} rows: {e}")
+        st.stop()
 
     st.success("Done.")
-    st.dataframe(out.head(30), use_container_width=True)
+    if head is not None:
+        st.dataframe(head, use_container_width=True)
 
-    buf = io.StringIO()
-    out.to_csv(buf, index=False)
-    st.download_button("Download results CSV", buf.getvalue(), file_name="distance_results.csv", mime="text/csv")
+    csv_bytes = b"".join(csv_parts)
+    del csv_parts
+    st.download_button("Download results CSV", csv_bytes, file_name="distance_results.csv", mime="text/csv")
 
 # --- Footer ---
 st.markdown("---")
@@ -0,0 +1,10 @@
+# build_gazetteer.py
+# Offline step: split the built-in gazetteer into per-FSA Parquet partitions
+# so the app only reads the FSAs a study needs.
+#   python build_gazetteer.py [path/to/ca_postals.csv.gz]
+import sys
+from core import GAZETTEER_FSA_DIR, write_gazetteer_by_fsa
+
+if __name__ == "__main__":
+    n = write_gazetteer_by_fsa(*sys.argv[1:2])
+    print(f"Wrote {n} postal codes to {GAZETTEER_FSA_DIR}/")
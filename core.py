@@ -1,11 +1,45 @@
 # core.py
+import contextlib
+import dataclasses
+import functools
 import os
+import shutil
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from typing import Dict, Tuple, Optional
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
 import openrouteservice as ors
-from openrouteservice import directions
+from openrouteservice import directions, distance_matrix
+from openrouteservice import exceptions as ors_exceptions
+from openrouteservice.exceptions import ApiError
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+from core_cache import distance_key, get_cached_distances, put_cached_distances
+from core_math import EARTH_RADIUS_KM, HAVE_NUMBA
+if HAVE_NUMBA:
+    from core_math import haversine_km_nb
+
+try:
+    import streamlit as st
+    _cache_resource = st.cache_resource(show_spinner=False)
+except ImportError:  # keep core.py importable outside Streamlit
+    def _cache_resource(func):
+        return func
+
+
+# A#A#A# with optional whitespace between characters; one group per character
+_POSTAL_RE = re.compile(r'([A-Z])\s*(\d)\s*([A-Z])\s*(\d)\s*([A-Z])\s*(\d)')
+# Already canonical 'A#A #A#' (the gazetteer's and most callers' form)
+_CANONICAL_RE = re.compile(r'[A-Z]\d[A-Z] \d[A-Z]\d')
+# A bare 3-character FSA ('A#A'), as in FSA-centroid gazetteers
+_FSA_RE = re.compile(r'[A-Z]\d[A-Z]')
+# First signed decimal number in a messy coordinate cell (e.g. '49.26 N')
+_FLOAT_RE = re.compile(r'[-+]?\d+(?:\.\d+)?')
 
 
 def normalize_postal(pc: str) -> str:
@@ -17,60 +51,215 @@ def normalize_postal(pc: str) -> str:
     if not isinstance(pc, str):
         return ""
     s = pc.upper()
-    m = re.search(r'([A-Z]\s*[\d]\s*[A-Z]\s*[\d]\s*[A-Z]\s*[\d])', s)
+    if len(s) == 7 and _CANONICAL_RE.fullmatch(s):
+        return s
+    m = _POSTAL_RE.search(s)
     if not m:
         return ""
-    alnum = "".join(ch for ch in m.group(1) if ch.isalnum())
-    if len(alnum) != 6:
-        return ""
-    return alnum[:3] + " " + alnum[3:]
+    a, b, c, d, e, f = m.groups()
+    return a + b + c + " " + d + e + f
+
+
+def normalize_postal_series(s: pd.Series) -> pd.Series:
+    """
+    Vectorized `normalize_postal` for a whole column: a single pandas regex
+    pass instead of one Python call per row. Rows without a postal become "".
+    Each distinct value is normalized once, so repeated postals cost nothing,
+    and values already in canonical form skip the extraction.
+    """
+    codes, uniques = pd.factorize(s.astype(str), sort=False)
+    norm = pd.Series(uniques, dtype=object).str.upper()
+    messy = ~norm.str.fullmatch(_CANONICAL_RE.pattern).to_numpy(dtype=bool)
+    if messy.any():
+        parts = norm[messy].str.extract(_POSTAL_RE.pattern, expand=True)
+        norm[messy] = (parts[0] + parts[1] + parts[2] + " " + parts[3] + parts[4] + parts[5]).fillna("")
+    return pd.Series(norm.to_numpy()[codes], index=s.index, dtype=object)
+
+
+# Meaningful decimals of float32-stored values: degrees (~1 m) and km (1 m)
+_COORD_DECIMALS = 5
+_KM_DECIMALS = 3
+
+
+@dataclasses.dataclass(frozen=True, eq=False)  # arrays: keep identity eq/hash
+class PostalLookup:
+    """
+    Gazetteer in columnar form: unique canonical 'ABC 123' keys in a pd.Index,
+    with float32 lat/lon arrays aligned to it. Much smaller than a dict of
+    float tuples, and `lookup_many` resolves a whole column in one call.
+    Normalize postals (see `normalize_postal`) before looking them up.
+    `fsa`, if set, maps 3-character FSAs ('ABC') to the centroid of their
+    postals, as a fallback for postals missing from the gazetteer.
+    """
+    keys: pd.Index
+    lats: np.ndarray
+    lons: np.ndarray
+    fsa: Optional["PostalLookup"] = None
+
+    @classmethod
+    def from_dict(cls, m: Dict[str, Tuple[float, float]]) -> "PostalLookup":
+        return cls(
+            keys=pd.Index(list(m), dtype=object),
+            lats=np.array([v[0] for v in m.values()], dtype=np.float32),
+            lons=np.array([v[1] for v in m.values()], dtype=np.float32),
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __bool__(self) -> bool:
+        # Usable if it can place anything: exact postals or FSA centroids
+        return len(self.keys) > 0 or bool(self.fsa)
+
+    def __contains__(self, pc) -> bool:
+        return pc in self.keys
+
+    def get(self, pc: str, default=None) -> Optional[Tuple[float, float]]:
+        i = self.keys.get_indexer([pc])[0]
+        if i < 0:
+            return default
+        # float32 carries ~7 digits; round so 49.26 doesn't read 49.259998
+        return (round(float(self.lats[i]), _COORD_DECIMALS), round(float(self.lons[i]), _COORD_DECIMALS))
+
+    def lookup_many(self, postals) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Resolve many normalized postals at once.
+        Returns (lats, lons, found); lat/lon are NaN where `found` is False.
+        """
+        idx = self.keys.get_indexer(postals)
+        found = idx >= 0
+        lats = np.full(len(idx), np.nan, dtype=np.float32)
+        lons = np.full(len(idx), np.nan, dtype=np.float32)
+        lats[found] = self.lats[idx[found]]
+        lons[found] = self.lons[idx[found]]
+        return lats, lons, found
+
+
+def _parse_float_series(s: pd.Series) -> pd.Series:
+    """
+    Coerce a coordinate column to float; messy cells (e.g. '49.26 N') take
+    the first number in the cell, and unparseable ones become NaN.
+    """
+    num = pd.to_numeric(s, errors="coerce")
+    dirty = num.isna() & s.notna()
+    if dirty.any():
+        num[dirty] = pd.to_numeric(
+            s[dirty].astype(str).str.extract(f"({_FLOAT_RE.pattern})", expand=False),
+            errors="coerce",
+        )
+    return num
+
+
+def _fsa_sums(postals: pd.Series, lat: pd.Series, lon: pd.Series) -> pd.DataFrame:
+    """Per-FSA coordinate sums and counts (mergeable across chunks)."""
+    return pd.DataFrame({
+        "lat": lat.to_numpy(np.float64),
+        "lon": lon.to_numpy(np.float64),
+        "n": 1,
+    }).groupby(postals.str[:3].to_numpy()).sum()
+
+
+def _fsa_lookup(sums: pd.DataFrame) -> PostalLookup:
+    """FSA centroid lookup from (possibly concatenated) `_fsa_sums` frames."""
+    sums = sums.groupby(level=0).sum()
+    return PostalLookup(
+        keys=pd.Index(sums.index, dtype=object),
+        lats=(sums["lat"] / sums["n"]).to_numpy(np.float32),
+        lons=(sums["lon"] / sums["n"]).to_numpy(np.float32),
+    )
 
 
 def build_postal_lookup_from_df(df: pd.DataFrame,
                                 postal_col: str,
                                 lat_col: str,
-                                lon_col: str) -> Dict[str, Tuple[float, float]]:
+                                lon_col: str) -> PostalLookup:
     """
-    Build a dict { 'ABC 123': (lat, lon), 'ABC123': (lat, lon) } from an uploaded gazetteer.
+    Build a `PostalLookup` of 'ABC 123' -> (lat, lon) from a gazetteer frame.
+    Keys are stored once, in canonical `normalize_postal` form; when a postal
+    repeats, the last row wins. FSA centroids are attached as `fsa`: rows
+    keyed by a bare FSA ('ABC') give it directly, otherwise it is the mean
+    of the FSA's postals.
+    Column-wise: normalize keys and coerce floats once, no Python row loop.
     """
-    m: Dict[str, Tuple[float, float]] = {}
+    keys = normalize_postal_series(df[postal_col])
+    lat = _parse_float_series(df[lat_col])
+    lon = _parse_float_series(df[lon_col])
+    has_coords = lat.notna() & lon.notna()
+
+    # Only rows that are not full postals can be bare FSAs
+    fsa_keys = df[postal_col][keys.eq("") & has_coords].astype(str).str.strip().str.upper()
+    fsa_keys = fsa_keys[fsa_keys.str.fullmatch(_FSA_RE.pattern)]
+    explicit = _fsa_sums(fsa_keys, lat[fsa_keys.index], lon[fsa_keys.index])
 
-    def parse_float(x) -> Optional[float]:
-        if pd.isna(x):
-            return None
-        s = str(x).strip()
-        mo = re.search(r'[-+]?\d+(?:\.\d+)?', s)
-        return float(mo.group(0)) if mo else None
+    keep = keys.ne("") & has_coords
+    keys, lat, lon = keys[keep], lat[keep], lon[keep]
+    last = ~keys.duplicated(keep="last")
+    keys, lat, lon = keys[last], lat[last], lon[last]
+    derived = _fsa_sums(keys, lat, lon)
+    return PostalLookup(
+        keys=pd.Index(keys.to_numpy(), dtype=object),
+        lats=lat.to_numpy(dtype=np.float32),
+        lons=lon.to_numpy(dtype=np.float32),
+        fsa=_fsa_lookup(pd.concat([derived.drop(index=explicit.index, errors="ignore"), explicit])),
+    )
 
-    for row in df.itertuples(index=False):
-        pc_raw = getattr(row, postal_col, None)
-        lat_raw = getattr(row, lat_col, None)
-        lon_raw = getattr(row, lon_col, None)
 
-        raw = "" if pc_raw is None else str(pc_raw)
-        alnum = "".join(ch for ch in raw.upper() if ch.isalnum())
-        if not alnum:
-            continue
+# Below this many destinations the NumPy path beats Numba's call overhead
+_NUMBA_MIN_SIZE = 50_000
 
-        key_spaced = alnum[:3] + " " + alnum[3:] if len(alnum) == 6 else alnum
-        key_nospace = alnum
 
-        lat = parse_float(lat_raw)
-        lon = parse_float(lon_raw)
-        if lat is None or lon is None:
-            continue
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """
+    Great-circle ("straight-line") distance in km, vectorized over arrays;
+    scalars broadcast, NaN inputs give NaN.
+    One origin against many destinations uses the Numba kernel in
+    core_math.py when it is installed and the batch is large.
+    """
+    if HAVE_NUMBA and np.ndim(lat1) == 0 and np.ndim(lon1) == 0 and np.ndim(lat2) == 1 \
+            and np.size(lat2) >= _NUMBA_MIN_SIZE:
+        lat2 = np.ascontiguousarray(lat2, dtype=np.float64)
+        lon2 = np.ascontiguousarray(lon2, dtype=np.float64)
+        out = np.empty(lat2.shape[0], dtype=np.float64)
+        haversine_km_nb(float(lat1), float(lon1), lat2, lon2, out)
+        return out
+
+    r = EARTH_RADIUS_KM
+    la1 = np.radians(np.asarray(lat1, dtype=np.float64))
+    la2 = np.radians(np.asarray(lat2, dtype=np.float64))
+    dlat = la2 - la1
+    dlon = np.radians(np.asarray(lon2, dtype=np.float64) - np.asarray(lon1, dtype=np.float64))
+    a = np.sin(dlat / 2) ** 2 + np.cos(la1) * np.cos(la2) * np.sin(dlon / 2) ** 2
+    return 2 * r * np.arcsin(np.sqrt(a))
 
-        m[key_spaced] = (lat, lon)
-        m[key_nospace] = (lat, lon)
 
-    return m
+# Keep-alive connections per client; must cover the largest max_concurrency
+ORS_POOL_SIZE = 32
 
 
 def get_ors_client(api_key: Optional[str] = None) -> ors.Client:
     api_key = api_key or os.environ.get("ORS_API_KEY", "")
     if not api_key:
         raise RuntimeError("OpenRouteService API key is missing.")
-    return ors.Client(key=api_key)
+    return _ors_client(api_key)
+
+
+@functools.lru_cache(maxsize=4)
+def _ors_client(api_key: str) -> ors.Client:
+    """
+    One client per API key, reused across rows, threads and reruns, so its
+    requests.Session keeps TLS connections alive instead of re-handshaking.
+    ORS itself retries 503s; 429s are raised to the caller, which waits on
+    its `_RateLimiter` and re-enqueues (see `_call_paced`) so retries count
+    against the request budget. The adapter only retries failed connects.
+    """
+    client = ors.Client(key=api_key, retry_over_query_limit=False)
+    adapter = HTTPAdapter(
+        pool_connections=ORS_POOL_SIZE,
+        pool_maxsize=ORS_POOL_SIZE,
+        max_retries=Retry(connect=3, read=0, backoff_factor=0.5),
+    )
+    client._session.mount("https://", adapter)  # ors.Client has no public Session hook
+    return client
 
 
 def route_km_via_ors(client: ors.Client,
@@ -90,8 +279,320 @@ def route_km_via_ors(client: ors.Client,
     return float(res["features"][0]["properties"]["segments"][0]["distance"])
 
 
+def route_km_matrix(client: ors.Client,
+                    origin_lonlat: Tuple[float, float],
+                    dest_lonlats: List[Tuple[float, float]],
+                    chunk: int = 50,
+                    requests_per_minute: Optional[float] = None,
+                    limiter: Optional["_RateLimiter"] = None) -> List[object]:
+    """
+    One-to-many driving-car distances in km via the ORS matrix endpoint,
+    `chunk` destinations per request (1 x 50 stays far below the ORS
+    matrix cell limit). ORS expects (lon, lat) pairs.
+    Chunk requests are paced by `limiter`, or to `requests_per_minute` if
+    given; pass one limiter to every call of a run so the budget is shared.
+    The limiter also backs off on ORS rate-limit responses (see
+    `_RateLimiter.observe`).
+    Returns one entry per destination, in order: the distance in km; None
+    where ORS found no route or the chunk's request failed transiently
+    (worth retrying per destination); or the exception for errors that
+    would fail again (bad key, exhausted quota, rejected request). After a
+    401/403 or an exhausted quota the remaining chunks are not sent.
+    """
+    if limiter is None and requests_per_minute:
+        limiter = _RateLimiter(requests_per_minute)
+    out: List[object] = []
+    fatal: Optional[Exception] = None
+    with _observing(client, limiter):
+        for i in range(0, len(dest_lonlats), chunk):
+            dests = [list(d) for d in dest_lonlats[i:i + chunk]]
+            if fatal is not None:
+                out.extend([fatal] * len(dests))
+                continue
+            try:
+                res = _call_paced(limiter, lambda: distance_matrix.distance_matrix(
+                    client=client,
+                    locations=[list(origin_lonlat)] + dests,
+                    profile="driving-car",
+                    sources=[0],
+                    destinations=list(range(1, len(dests) + 1)),
+                    metrics=["distance"],
+                    units="km",
+                ))
+                row = res["distances"][0]
+            except Exception as e:
+                if not _is_transient(e):
+                    out.extend([e] * len(dests))
+                    if getattr(e, "status", None) in (401, 403, 429):
+                        fatal = e
+                    continue
+                row = [None] * len(dests)
+            out.extend(None if d is None else float(d) for d in row)
+    return out
+
+
+def _is_transient(err: Exception) -> bool:
+    """Network trouble or a 5xx: the same request may well succeed later."""
+    if isinstance(err, ApiError):
+        return isinstance(err.status, int) and err.status >= 500
+    return isinstance(err, (ors_exceptions.Timeout, ors_exceptions.HTTPError,
+                            requests.RequestException))
+
+
+class _RateLimiter:
+    """
+    Sliding-window limiter shared by all routing threads: lets at most
+    `rate_per_min` calls to `wait()` through in any `period_s` window.
+    Installed as a requests response hook (`observe`), it also holds every
+    thread back when ORS signals pressure, and marks the limiter `exhausted`
+    when the quota only resets after the window (e.g. the daily quota).
+    """
+
+    def __init__(self, rate_per_min: float, period_s: float = 60.0):
+        self.rate = max(1, int(rate_per_min))
+        self.period = float(period_s)
+        self._stamps: deque = deque()
+        self._paused_until = 0.0
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._paused_until - now
+                if delay <= 0:
+                    while self._stamps and now - self._stamps[0] >= self.period:
+                        self._stamps.popleft()
+                    if len(self._stamps) < self.rate:
+                        self._stamps.append(now)
+                        return
+                    delay = self.period - (now - self._stamps[0])
+            time.sleep(max(0.0, delay))
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def observe(self, response, *args, **kwargs) -> None:
+        """
+        Response hook: on a 429 wait `Retry-After` seconds (default: one
+        request slot); when `x-ratelimit-remaining` hits 0, wait for
+        `x-ratelimit-reset` if that falls inside the window. Longer waits
+        mean the daily quota is gone: the limiter is marked `exhausted` and
+        over-limit requests fail fast instead of being retried.
+        """
+        headers = response.headers
+        if headers.get("x-ratelimit-remaining") == "0":
+            try:
+                until_reset = float(headers.get("x-ratelimit-reset")) - time.time()
+            except (TypeError, ValueError):
+                until_reset = None
+            if until_reset is not None:
+                if until_reset > self.period:
+                    self.exhausted = True
+                elif until_reset > 0:
+                    self.pause(until_reset)
+        if response.status_code == 429:
+            try:
+                retry_after = float(headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                retry_after = self.period / self.rate
+            if retry_after > self.period:
+                self.exhausted = True
+            else:
+                self.pause(retry_after)
+
+
+# Re-enqueues of one request after 429s before giving up on it
+_MAX_OVER_LIMIT_RETRIES = 5
+
+
+def _call_paced(limiter: Optional[_RateLimiter], call):
+    """
+    `call()` once `limiter` lets it through. On an ORS 429 (the limiter's
+    `observe` hook has already paused for Retry-After) go back through
+    `limiter.wait()` and try again, unless the quota is exhausted for
+    longer than the window or the retries are used up.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return call()
+        except ApiError as e:
+            if (e.status != 429 or limiter is None or limiter.exhausted
+                    or attempt >= _MAX_OVER_LIMIT_RETRIES):
+                raise
+            attempt += 1
+
+
+@contextlib.contextmanager
+def _observing(client: ors.Client, limiter: Optional[_RateLimiter]) -> Iterator[None]:
+    """Feed every ORS response to `limiter.observe` while the block runs."""
+    if limiter is None:
+        yield
+        return
+    hooks = client._session.hooks["response"]  # every ORS response passes through here
+    hooks.append(limiter.observe)
+    try:
+        yield
+    finally:
+        hooks.remove(limiter.observe)
+
+
+def route_many_via_ors(client: ors.Client,
+                       origin_lonlat: Tuple[float, float],
+                       dest_lonlats: List[Tuple[float, float]],
+                       max_concurrency: int = 8,
+                       requests_per_minute: float = 40,
+                       limiter: Optional[_RateLimiter] = None) -> List[object]:
+    """
+    Route origin -> each destination with up to `max_concurrency` requests in
+    flight, paced globally to `requests_per_minute` (or by a `limiter` shared
+    across calls) and backing off when ORS reports rate-limit pressure (see
+    `_RateLimiter.observe`).
+    Returns one entry per destination, in order: the distance in km, or the
+    exception raised for that destination.
+    """
+    if not dest_lonlats:
+        return []
+    if limiter is None:
+        limiter = _RateLimiter(requests_per_minute)
+
+    def one(dest):
+        try:
+            return _call_paced(limiter, lambda: route_km_via_ors(client, origin_lonlat, dest))
+        except Exception as e:
+            return e
+
+    with _observing(client, limiter), \
+            ThreadPoolExecutor(max_workers=max(1, int(max_concurrency))) as ex:
+        return list(ex.map(one, dest_lonlats))
+
+
+def _gazetteer_columns(columns) -> Tuple[str, str, str]:
+    """
+    Pick the (postal, lat, lon) columns of a gazetteer by name, falling back
+    to the first three columns.
+    """
+    cols = {c.lower(): c for c in columns}
+    columns = list(columns)
+    postal_col = cols.get("postal") or cols.get("postal_code") or columns[0]
+    lat_col    = cols.get("lat")    or cols.get("latitude")    or columns[1]
+    lon_col    = cols.get("lon")    or cols.get("lng") or cols.get("longitude") or columns[2]
+    return postal_col, lat_col, lon_col
+
+
+def _existing_paths(paths: Iterable[str]) -> List[str]:
+    """
+    The candidate files that exist, in order. Windows-style 'data\\x' entries
+    are normalized to the local separator first, so duplicates collapse.
+    """
+    norm = dict.fromkeys(os.path.normpath(p.replace("\\", os.sep)) for p in paths)
+    return [p for p in norm if os.path.isfile(p)]
+
+
+def _csv_compression(p: str) -> str:
+    """
+    Compression of a CSV file from its magic bytes rather than its name, so
+    e.g. a gzip saved as 'ca_postals.csv.gz.csv' still goes to the C parser.
+    Anything else (plain text, zip, zstd, ...) is left to pandas' "infer".
+    """
+    with open(p, "rb") as f:
+        magic = f.read(6)
+    if magic.startswith(b"\x1f\x8b"):
+        return "gzip"
+    if magic.startswith(b"\xfd7zXZ\x00"):
+        return "xz"
+    if magic.startswith(b"BZh"):
+        return "bz2"
+    return "infer"
+
+
+def _read_gazetteer(p: str) -> Tuple[pd.DataFrame, str, str, str]:
+    """
+    Read only the (postal, lat, lon) columns of a gazetteer file.
+    Returns (df, postal_col, lat_col, lon_col).
+    """
+    if p.endswith(".parquet"):
+        df = pd.read_parquet(p)
+        return (df, *_gazetteer_columns(df.columns))
+
+    compression = _csv_compression(p)
+    hdr = pd.read_csv(p, nrows=0, compression=compression)
+    postal_col, lat_col, lon_col = _gazetteer_columns(hdr.columns)
+    usecols = [postal_col, lat_col, lon_col]
+    # lat/lon stay untyped here: the shipped file has a few malformed
+    # rows, and build_postal_lookup_from_df coerces them anyway.
+    try:
+        df = pd.read_csv(p, engine="pyarrow", usecols=usecols, dtype={postal_col: str},
+                         compression=compression)
+    except Exception:
+        df = pd.read_csv(p, engine="c", usecols=usecols, dtype={postal_col: str},
+                         on_bad_lines="skip", low_memory=False, compression=compression)
+    return df, postal_col, lat_col, lon_col
+
+
+# Built-in gazetteer as Parquet partitioned by FSA (first 3 chars of the
+# postal), written offline by build_gazetteer.py.
+GAZETTEER_FSA_DIR = os.path.join("data", "ca_postals_by_fsa")
+
+
+def write_gazetteer_by_fsa(src: str = "data/ca_postals.csv.gz",
+                           out_dir: str = GAZETTEER_FSA_DIR) -> int:
+    """
+    Rewrite a gazetteer as canonical (postal, lat, lon) Parquet partitioned by
+    FSA, so `load_gazetteer_subset` reads only the FSAs a study needs.
+    Returns the number of postal codes written.
+    """
+    df, postal_col, lat_col, lon_col = _read_gazetteer(src)
+    out = pd.DataFrame({
+        "postal": normalize_postal_series(df[postal_col]),
+        "lat": _parse_float_series(df[lat_col]),
+        "lon": _parse_float_series(df[lon_col]),
+    })
+    out = out[out["postal"].ne("") & out["lat"].notna() & out["lon"].notna()]
+    out = out.drop_duplicates("postal", keep="last")
+    out["fsa"] = out["postal"].str[:3]
+
+    shutil.rmtree(out_dir, ignore_errors=True)  # partitions would otherwise be appended to
+    out.to_parquet(out_dir, partition_cols=["fsa"], index=False, max_partitions=4096)  # ~1.6k FSAs
+    return len(out)
+
+
+def _fresh_sidecar(p: str) -> Optional[str]:
+    """The Parquet sidecar of gazetteer CSV `p`, if it exists and is newer than `p`."""
+    sidecar = p + ".parquet"
+    try:
+        return sidecar if os.path.getmtime(sidecar) > os.path.getmtime(p) else None
+    except OSError:
+        return None
+
+
+def _fresh_dir(d: str, sources: List[str]) -> bool:
+    """True if directory `d` exists and is newer than every file in `sources`."""
+    try:
+        return os.path.isdir(d) and all(os.path.getmtime(d) > os.path.getmtime(s) for s in sources)
+    except OSError:
+        return False
+
+
+def _write_parquet_sidecar(lookup: PostalLookup, path: str) -> None:
+    """Best-effort (postal, lat, lon) Parquet copy of a parsed gazetteer."""
+    try:
+        pd.DataFrame({"postal": lookup.keys, "lat": lookup.lats, "lon": lookup.lons}) \
+            .to_parquet(path, index=False, compression="snappy")
+    except Exception:  # e.g. read-only deploy: just parse the CSV again next time
+        pass
+
+
+@_cache_resource
 def load_builtin_gazetteer(
     paths=(
+        # Parquet copy (typed, columnar) if one has been generated
+        "ca_postals.parquet", "data/ca_postals.parquet",
         # repo root
         "ca_postals.csv.gz", "ca_postals.csv",
         r"ca_postals.csv.gz", r"ca_postals.csv",
@@ -103,102 +604,143 @@ def load_builtin_gazetteer(
         r"data\ca_postals.csv.gz",
         r"data\ca_postals.csv",
     )
-) -> Dict[str, Tuple[float, float]]:
+) -> PostalLookup:
     """
     FULL in-memory gazetteer loader (kept for uploads/local use).
     Avoid calling this on Render free tier (may exceed memory).
+    Cached per process under Streamlit, so reruns do not re-parse the file.
+    After a CSV load, a '<csv>.parquet' sidecar is written next to it, and
+    later cold starts read that instead while it is newer than the CSV.
     """
+    candidates = _existing_paths(paths)
+    if not candidates:
+        raise RuntimeError(f"Could not load built-in gazetteer: none of {list(paths)} exists.")
     last_err = None
-    for p in paths:
+    for p in candidates:
         try:
-            df = pd.read_csv(p, engine="python", on_bad_lines="skip")
-            cols = {c.lower(): c for c in df.columns}
-            postal_col = cols.get("postal") or cols.get("postal_code") or list(df.columns)[0]
-            lat_col    = cols.get("lat")    or cols.get("latitude")    or list(df.columns)[1]
-            lon_col    = cols.get("lon")    or cols.get("lng") or cols.get("longitude") or list(df.columns)[2]
-            return build_postal_lookup_from_df(df, postal_col, lat_col, lon_col)
+            if not p.endswith(".parquet"):
+                sidecar = _fresh_sidecar(p)
+                if sidecar:
+                    try:
+                        return build_postal_lookup_from_df(*_read_gazetteer(sidecar))
+                    except Exception:  # unreadable sidecar: fall back to the CSV
+                        pass
+            df, postal_col, lat_col, lon_col = _read_gazetteer(p)
+            lookup = build_postal_lookup_from_df(df, postal_col, lat_col, lon_col)
+            if not p.endswith(".parquet"):
+                _write_parquet_sidecar(lookup, p + ".parquet")
+            return lookup
         except Exception as e:
             last_err = e
-    raise RuntimeError(f"Could not load built-in gazetteer from {paths}. Last error: {last_err}")
+    raise RuntimeError(f"Could not load built-in gazetteer from {candidates}. Last error: {last_err}")
+
+
+# Built-in gazetteer CSV locations, in lookup order
+GAZETTEER_CSV_PATHS = (
+    # repo root
+    "ca_postals.csv.gz", "ca_postals.csv",
+    r"ca_postals.csv.gz", r"ca_postals.csv",
+    # data/ subfolder
+    "data/ca_postals.csv.gz.csv",
+    "data/ca_postals.csv.gz",
+    "data/ca_postals.csv",
+    r"data\ca_postals.csv.gz.csv",
+    r"data\ca_postals.csv.gz",
+    r"data\ca_postals.csv",
+)
 
 
 def load_gazetteer_subset(
     needed_postals: set,
-    paths=(
-        # repo root
-        "ca_postals.csv.gz", "ca_postals.csv",
-        r"ca_postals.csv.gz", r"ca_postals.csv",
-        # data/ subfolder
-        "data/ca_postals.csv.gz.csv",
-        "data/ca_postals.csv.gz",
-        "data/ca_postals.csv",
-        r"data\ca_postals.csv.gz.csv",
-        r"data\ca_postals.csv.gz",
-        r"data\ca_postals.csv",
-    ),
+    paths=GAZETTEER_CSV_PATHS,
     chunksize: int = 200_000,
-) -> Dict[str, Tuple[float, float]]:
+    fsa_dir: Optional[str] = GAZETTEER_FSA_DIR,
+) -> PostalLookup:
     """
-    Memory-light loader: scan the large gazetteer in chunks and only keep rows
-    whose normalized postal is in `needed_postals`. Returns a small dict mapping
-    both 'ABC 123' and 'ABC123' to (lat, lon).
+    Memory-light loader: only keep rows whose normalized postal is in
+    `needed_postals`. Returns a small `PostalLookup` of 'ABC 123' -> (lat, lon).
+    For the built-in `paths`, if the FSA-partitioned Parquet copy in `fsa_dir`
+    exists (see `write_gazetteer_by_fsa`) and is newer than the CSV, only the
+    partitions for the needed FSAs are read; otherwise (custom `paths`,
+    `fsa_dir=None`, or a stale copy) the gazetteer CSV is scanned in chunks.
+    Either way, centroids of the needed FSAs are computed from all their
+    postals and attached as `fsa`.
     """
     # Normalize the target set once
-    needed_norm = set()
-    for pc in needed_postals:
-        pc_n = normalize_postal(str(pc))
-        if pc_n:
-            needed_norm.add(pc_n)
-            needed_norm.add(pc_n.replace(" ", ""))  # also accept nospace variant
+    needed_norm = set(normalize_postal_series(pd.Series(list(needed_postals), dtype=object)))
+    needed_norm.discard("")
 
     if not needed_norm:
-        return {}
+        return PostalLookup.from_dict({})
+
+    needed_fsa = {k[:3] for k in needed_norm}
+
+    candidates = _existing_paths(paths)
+    if fsa_dir and paths is GAZETTEER_CSV_PATHS and _fresh_dir(fsa_dir, candidates[:1]):
+        parts = [os.path.join(fsa_dir, f"fsa={fsa}") for fsa in sorted(needed_fsa)]
+        frames = [pd.read_parquet(p, columns=["postal", "lat", "lon"]) for p in parts if os.path.isdir(p)]
+        if not frames:
+            return PostalLookup.from_dict({})
+        near = pd.concat(frames, ignore_index=True)
+        sub = near[near["postal"].isin(needed_norm)]
+        return dataclasses.replace(
+            build_postal_lookup_from_df(sub, "postal", "lat", "lon"),
+            fsa=_fsa_lookup(_fsa_sums(near["postal"], near["lat"], near["lon"])),
+        )
 
+    if not candidates:
+        raise RuntimeError(f"Could not build subset gazetteer: none of {list(paths)} exists.")
     last_err = None
-    for p in paths:
+    for p in candidates:
         try:
             # Read header to detect columns once
-            hdr = pd.read_csv(p, nrows=0)
-            cols = {c.lower(): c for c in hdr.columns}
-            postal_col = cols.get("postal") or cols.get("postal_code") or list(hdr.columns)[0]
-            lat_col    = cols.get("lat")    or cols.get("latitude")    or list(hdr.columns)[1]
-            lon_col    = cols.get("lon")    or cols.get("lng") or cols.get("longitude") or list(hdr.columns)[2]
+            compression = _csv_compression(p)
+            hdr = pd.read_csv(p, nrows=0, compression=compression)
+            postal_col, lat_col, lon_col = _gazetteer_columns(hdr.columns)
 
             m: Dict[str, Tuple[float, float]] = {}
-            # Stream the file in chunks to keep memory small
+            fsa_sums: List[pd.DataFrame] = []
+            remaining = set(needed_norm)
+            # Stream the file in chunks to keep memory small. pyarrow cannot
+            # chunk, so use the C parser; lat/lon are read as text because of
+            # the malformed rows (see _read_gazetteer) and parsed below.
             for chunk in pd.read_csv(
                 p,
                 usecols=[postal_col, lat_col, lon_col],
-                engine="python",
+                dtype=str,
+                engine="c",
+                compression=compression,
                 on_bad_lines="skip",
                 chunksize=chunksize,
             ):
-                for row in chunk.itertuples(index=False):
-                    raw = "" if getattr(row, postal_col) is None else str(getattr(row, postal_col))
-                    key = normalize_postal(raw)
-                    if not key:
-                        continue
-                    if (key not in needed_norm) and (key.replace(" ", "") not in needed_norm):
-                        continue
-                    # robust float parsing
-                    lat_s = str(getattr(row, lat_col)).strip()
-                    lon_s = str(getattr(row, lon_col)).strip()
-                    try:
-                        latf = float(re.search(r'[-+]?\d+(?:\.\d+)?', lat_s).group(0))
-                        lonf = float(re.search(r'[-+]?\d+(?:\.\d+)?', lon_s).group(0))
-                    except Exception:
-                        continue
-                    m[key] = (latf, lonf)
-                    m[key.replace(" ", "")] = (latf, lonf)
+                # Normalize the whole postal column at once, keep only rows in
+                # the needed FSAs (for centroids), then only needed postals
+                chunk_norm = normalize_postal_series(chunk[postal_col])
+                near = chunk_norm.str[:3].isin(needed_fsa).to_numpy()
+                if not near.any():
+                    continue
+                lat = _parse_float_series(chunk.loc[near, lat_col])
+                lon = _parse_float_series(chunk.loc[near, lon_col])
+                ok = (lat.notna() & lon.notna()).to_numpy()
+                keys, lat, lon = chunk_norm[near][ok], lat[ok], lon[ok]
+                fsa_sums.append(_fsa_sums(keys, lat, lon))
+
+                keep = keys.isin(needed_norm).to_numpy()
+                m.update(zip(keys[keep],
+                             zip(lat[keep].to_numpy(np.float64), lon[keep].to_numpy(np.float64))))
 
                 # Early exit if we've found everything
-                if all((k in m) or (k.replace(" ", "") in m) for k in needed_norm):
+                remaining.difference_update(keys[keep])
+                if not remaining:
                     break
-            return m
+            lookup = PostalLookup.from_dict(m)
+            if fsa_sums:
+                lookup = dataclasses.replace(lookup, fsa=_fsa_lookup(pd.concat(fsa_sums)))
+            return lookup
         except Exception as e:
             last_err = e
             continue
-    raise RuntimeError(f"Could not build subset gazetteer from {paths}. Last error: {last_err}")
+    raise RuntimeError(f"Could not build subset gazetteer from {candidates}. Last error: {last_err}")
 
 
 def process_dataframe(df: pd.DataFrame,
@@ -206,12 +748,37 @@ def process_dataframe(df: pd.DataFrame,
                       postal_col: str,
                       origin_lon: float,
                       origin_lat: float,
-                      postal_lookup: Dict[str, Tuple[float, float]],
+                      postal_lookup: PostalLookup,
                       api_key: str,
-                      sleep_s: float = 1.0) -> pd.DataFrame:
+                      max_concurrency: int = 8,
+                      requests_per_minute: float = 40,
+                      use_cache: bool = True,
+                      normalized_postals: Optional[pd.Series] = None,
+                      max_straight_km: Optional[float] = None,
+                      memo: Optional[Dict[Tuple[float, float], float]] = None,
+                      matrix_limiter: Optional[_RateLimiter] = None,
+                      directions_limiter: Optional[_RateLimiter] = None) -> pd.DataFrame:
     """
-    For each row, normalize the destination postal, look up lat/lon from the
-    (subset) gazetteer, route via ORS, and return a new DataFrame.
+    Normalize the destination postals, look up lat/lon from the (subset)
+    gazetteer, route each distinct postal via ORS once, and return a copy of
+    `df` with `distance_km`, `straight_km` (haversine), `located_by` and
+    `error` columns. Postals missing from the gazetteer fall back to their
+    FSA centroid when the lookup has one (`located_by` is then "fsa").
+    Unique destinations are routed in batches through the ORS matrix
+    endpoint; any the matrix could not answer fall back to concurrent
+    per-destination directions requests (see `route_many_via_ors`).
+    With `use_cache`, distances from earlier runs are read from (and new ones
+    written to) the on-disk cache in core_cache.py instead of calling ORS.
+    Pass `normalized_postals` (row-aligned output of `normalize_postal_series`)
+    when the caller already has it, to skip normalizing the column again.
+    With `max_straight_km`, destinations farther than that in a straight line
+    are not routed (their `straight_km` is still filled in).
+    `memo` is an in-memory {dest (lon, lat): km} for this origin, shared
+    across calls (see `iter_process_chunks`): destinations in it are not
+    routed again, and new distances are added to it.
+    `matrix_limiter` / `directions_limiter` pace the two ORS endpoints; pass
+    the same ones to every call of a run so `requests_per_minute` holds across
+    calls (by default each call starts a fresh budget).
     """
     study_id_col = str(study_id_col).strip()
     postal_col = str(postal_col).strip()
@@ -219,26 +786,112 @@ def process_dataframe(df: pd.DataFrame,
     client = get_ors_client(api_key)
     origin = (float(origin_lon), float(origin_lat))  # (lon, lat)
 
-    out_rows = []
-    for _, row in df.iterrows():
-        rec = row.to_dict()
-        postal_val = rec.get(postal_col, None)
-        pc = normalize_postal("" if postal_val is None else str(postal_val))
+    if normalized_postals is not None:
+        pcs = normalized_postals
+    else:
+        postals = df[postal_col] if postal_col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        pcs = normalize_postal_series(postals)
 
-        error, dist_km = "", None
-        try:
-            if pc and pc in postal_lookup:
-                lat, lon = postal_lookup[pc]      # (lat, lon) stored
-                dest = (float(lon), float(lat))   # ORS expects (lon, lat)
-                dist_km = route_km_via_ors(client, origin, dest)
-            else:
-                error = "Invalid Postal Code"
-        except Exception as e:
-            error = f"Routing error: {e}"
+    # Route each distinct postal once: results live in per-postal arrays and
+    # are gathered back onto rows with `codes` at the end.
+    codes, uniques = pd.factorize(pcs)
+    u_dist = np.full(len(uniques), np.nan, dtype=np.float32)
+    u_err = np.full(len(uniques), "Invalid Postal Code", dtype=object)
+
+    lats, lons, found = postal_lookup.lookup_many(uniques)
+    u_located = np.where(found, "postal", "").astype(object)
+    if postal_lookup.fsa is not None:
+        near = np.flatnonzero(~found & (np.asarray(uniques, dtype=object) != ""))
+        f_lats, f_lons, f_found = postal_lookup.fsa.lookup_many([uniques[i][:3] for i in near])
+        near = near[f_found]
+        lats[near], lons[near] = f_lats[f_found], f_lons[f_found]
+        found[near] = True
+        u_located[near] = "fsa"
+    u_straight = haversine_km(origin_lat, origin_lon, lats, lons).astype(np.float32)
+    u_err[found] = ""
+
+    routable = found
+    if max_straight_km is not None:
+        routable = found & (u_straight < max_straight_km)
+        u_err[found & ~routable] = f"Not routed: straight-line distance over {max_straight_km:g} km"
+
+    dests: Dict[int, Tuple[float, float]] = {
+        i: (float(lons[i]), float(lats[i]))             # ORS expects (lon, lat)
+        for i in np.flatnonzero(routable)
+    }
+
+    unique_dests = list(dict.fromkeys(dests.values()))
+    dist_by_dest: Dict[Tuple[float, float], object] = {}
+    if memo:
+        dist_by_dest.update((dest, memo[dest]) for dest in unique_dests if dest in memo)
+    if use_cache:
+        lookup = {distance_key(origin, dest): dest for dest in unique_dests if dest not in dist_by_dest}
+        for key, km in get_cached_distances(lookup).items():
+            dist_by_dest[lookup[key]] = km
 
-        rec["distance_km"] = dist_km
-        rec["error"] = error
-        out_rows.append(rec)
-        time.sleep(max(0.0, sleep_s))  # polite pacing
+    to_route = [dest for dest in unique_dests if dest not in dist_by_dest]
+    if matrix_limiter is None:
+        matrix_limiter = _RateLimiter(requests_per_minute)
+    dist_by_dest.update(zip(to_route, route_km_matrix(client, origin, to_route,
+                                                      limiter=matrix_limiter)))
 
-    return pd.DataFrame(out_rows)
+    # Per-destination fallback for anything the matrix could not answer
+    retry = [dest for dest, km in dist_by_dest.items() if km is None]
+    results = route_many_via_ors(
+        client, origin, retry,
+        max_concurrency=max_concurrency,
+        requests_per_minute=requests_per_minute,
+        limiter=directions_limiter,
+    )
+    dist_by_dest.update(zip(retry, results))
+
+    if use_cache:
+        put_cached_distances(
+            (distance_key(origin, dest), dist_by_dest[dest]) for dest in to_route
+            if isinstance(dist_by_dest[dest], float)
+        )
+    if memo is not None:
+        memo.update((dest, km) for dest, km in dist_by_dest.items() if not isinstance(km, Exception))
+
+    for i, dest in dests.items():
+        res = dist_by_dest[dest]
+        if isinstance(res, Exception):
+            u_err[i] = f"Routing error: {res}"
+        else:
+            u_dist[i] = res
+
+    # float32 working arrays; report float64 rounded to the metre, not float32 noise
+    return df.assign(distance_km=u_dist.astype(np.float64).round(_KM_DECIMALS)[codes],
+                     straight_km=u_straight.astype(np.float64).round(_KM_DECIMALS)[codes],
+                     located_by=u_located[codes], error=u_err[codes])
+
+
+def iter_process_chunks(chunks: Iterable[pd.DataFrame],
+                        study_id_col: str,
+                        postal_col: str,
+                        origin_lon: float,
+                        origin_lat: float,
+                        postal_lookup: PostalLookup,
+                        api_key: str,
+                        normalized_postals: Optional[pd.Series] = None,
+                        **kwargs) -> Iterator[pd.DataFrame]:
+    """
+    Streaming `process_dataframe`: route each chunk of a chunked reader
+    (e.g. `pd.read_csv(..., chunksize=10_000)`) and yield its results as soon
+    as they are ready, so memory stays flat regardless of file size.
+    `normalized_postals`, if given, covers the whole file and is sliced to
+    each chunk by position. A postal is routed once for the whole stream,
+    even with the disk cache off, and the ORS request budget is shared by
+    all chunks. Other keyword arguments go to `process_dataframe`.
+    """
+    rpm = kwargs.get("requests_per_minute", 40)
+    kwargs.setdefault("memo", {})
+    kwargs.setdefault("matrix_limiter", _RateLimiter(rpm))
+    kwargs.setdefault("directions_limiter", _RateLimiter(rpm))
+    offset = 0
+    for chunk in chunks:
+        if normalized_postals is not None:
+            kwargs["normalized_postals"] = normalized_postals.iloc[offset:offset + len(chunk)]
+            offset += len(chunk)
+        yield process_dataframe(chunk, study_id_col, postal_col, origin_lon, origin_lat,
+                                postal_lookup, api_key, **kwargs)
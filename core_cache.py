@@ -0,0 +1,81 @@
+# core_cache.py
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# On-disk cache of ORS driving distances, shared across runs and sessions.
+CACHE_PATH = os.environ.get("ORS_CACHE_PATH", os.path.join("data", "ors_cache.sqlite"))
+
+# Keys per SELECT ... IN (...); stays under SQLite's host-parameter limit
+_BATCH = 500
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _db() -> sqlite3.Connection:
+    # Caller must hold _lock
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("CREATE TABLE IF NOT EXISTS ors_cache (key TEXT PRIMARY KEY, km REAL)")
+        _conn.commit()
+    return _conn
+
+
+def distance_key(origin_lonlat: Tuple[float, float], dest_lonlat: Tuple[float, float]) -> str:
+    """
+    Cache key for an origin -> destination pair of (lon, lat) points,
+    rounded to 6 decimals (~0.1 m) so float noise doesn't miss the cache.
+    """
+    (o_lon, o_lat), (d_lon, d_lat) = origin_lonlat, dest_lonlat
+    return f"{round(o_lat, 6)}:{round(o_lon, 6)}->{round(d_lat, 6)}:{round(d_lon, 6)}"
+
+
+def get_cached_distance(key: str) -> Optional[float]:
+    with _lock:
+        row = _db().execute("SELECT km FROM ors_cache WHERE key = ?", (key,)).fetchone()
+    return None if row is None else float(row[0])
+
+
+def get_cached_distances(keys: Iterable[str]) -> Dict[str, float]:
+    """Cached distances for many keys at once; keys not in the cache are absent."""
+    keys: List[str] = list(keys)
+    out: Dict[str, float] = {}
+    with _lock:
+        db = _db()
+        for i in range(0, len(keys), _BATCH):
+            batch = keys[i:i + _BATCH]
+            rows = db.execute(
+                f"SELECT key, km FROM ors_cache WHERE key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            out.update((k, float(km)) for k, km in rows)
+    return out
+
+
+def put_cached_distance(key: str, km: float) -> None:
+    with _lock:
+        db = _db()
+        db.execute("INSERT OR REPLACE INTO ors_cache (key, km) VALUES (?, ?)", (key, float(km)))
+        db.commit()
+
+
+def put_cached_distances(items: Iterable[Tuple[str, float]]) -> None:
+    """Store many (key, km) pairs in one transaction."""
+    rows = [(key, float(km)) for key, km in items]
+    if not rows:
+        return
+    with _lock:
+        db = _db()
+        db.executemany("INSERT OR REPLACE INTO ors_cache (key, km) VALUES (?, ?)", rows)
+        db.commit()
+
+
+def clear_cached_distances() -> None:
+    with _lock:
+        db = _db()
+        db.execute("DELETE FROM ors_cache")
+        db.commit()
@@ -0,0 +1,32 @@
+# core_math.py
+import math
+import numpy as np
+
+# Optional: Numba JIT for the haversine hot loop. Without it, callers use the
+# plain NumPy path (core.haversine_km).
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+EARTH_RADIUS_KM = 6371.0
+
+if HAVE_NUMBA:
+    # fastmath minus "nnan"/"ninf": unmatched postals arrive as NaN and must stay NaN
+    @njit(parallel=True, fastmath={"contract", "afn", "arcp", "reassoc", "nsz"}, cache=True)
+    def haversine_km_nb(lat1: float, lon1: float,
+                        lat2: np.ndarray, lon2: np.ndarray,
+                        out: np.ndarray) -> None:
+        """
+        One origin -> many destinations, written into `out`: a single fused,
+        multi-threaded pass with no temporary arrays.
+        """
+        la1 = math.radians(lat1)
+        cos_la1 = math.cos(la1)
+        for i in prange(lat2.shape[0]):
+            la2 = math.radians(lat2[i])
+            dlat = la2 - la1
+            dlon = math.radians(lon2[i] - lon1)
+            a = math.sin(dlat / 2) ** 2 + cos_la1 * math.cos(la2) * math.sin(dlon / 2) ** 2
+            out[i] = 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))